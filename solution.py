@@ -16,8 +16,10 @@
 
 import datetime
 
-from itertools import islice, groupby
-from typing import Iterator, List, Mapping, Tuple
+from array import array
+from collections import defaultdict
+from functools import cached_property
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
 
 
 class Service:
@@ -28,43 +30,86 @@ class Service:
     trip that a passenger can buy.
     """
 
-    def __init__(self, name: str, departure_date: datetime.date):
+    def __init__(self, name: str, departure_date: datetime.date, reference_date: Optional[datetime.date] = None):
         self.name = name
         self.departure_date = departure_date
+        self._reference_date = reference_date
         self.legs: List[Leg] = []
         self.ods: Mapping[Tuple[Station, Station], OD] = {}
+        # Same ODs as `ods`, indexed by origin then destination to avoid building a tuple key on each lookup
+        self._ods_by_origin: Dict[Station, Dict[Station, OD]] = defaultdict(dict)
+        # Position of each stop in the itinerary
+        self._station_index: Dict[Station, int] = {}
 
     @property
+    def reference_date(self) -> Optional[datetime.date]:
+        """Date the day-x scale is computed from, today if not given"""
+        return self._reference_date
+
+    @reference_date.setter
+    def reference_date(self, reference_date: Optional[datetime.date]) -> None:
+        self._reference_date = reference_date
+        # `day_x` depends on the reference date, it is computed again on next access
+        self.__dict__.pop("day_x", None)
+
+    @cached_property
     def day_x(self):
         """Number of days before departure.
 
         In revenue management systems, the day-x scale is often preferred because it is more convenient to manipulate
-        compared to dates."""
-        return (datetime.date.today() - self.departure_date).days
+        compared to dates.
+
+        Computed once: a report is expected to be built for a single reference date."""
+        reference_date = self.reference_date or datetime.date.today()
+        return (reference_date - self.departure_date).days
 
     def load_itinerary(self, itinerary: List["Station"]) -> None:
         """Helper to initialize a Service's `legs` and `ods` attributes"""
-        for i, station in enumerate(itinerary):
-            if i == 0:
-                # This is easier than starting at index 1 and managing an offset
-                continue
+        self._station_index = {station: i for i, station in enumerate(itinerary)}
 
-            for prev in islice(itinerary, i):
-                self.ods[(prev, station)] = (OD(self, prev, station))
+        # Stations already visited, each of them is the origin of an OD ending at the current station
+        seen: List[Station] = []
+        for station in itinerary:
+            if seen:
+                self.legs.append(Leg(self, seen[-1], station))
 
-            # prev == itinerary[i - 1]
-            self.legs.append(Leg(self, prev, station))
+            for prev in seen:
+                od = OD(self, prev, station)
+                self.ods[(prev, station)] = od
+                self._ods_by_origin[prev][station] = od
+
+            seen.append(station)
+
+    def _stop_index(self) -> Dict["Station", int]:
+        if not self._station_index and self.legs:
+            # Legs were set by hand instead of using `load_itinerary`
+            self._station_index = {leg.origin: i for i, leg in enumerate(self.legs)}
+            self._station_index[self.legs[-1].destination] = len(self.legs)
+        return self._station_index
 
     def load_passenger_manifest(self, passengers: List["Passenger"]) -> None:
         """Helper to initialize the `passengers` attribute of a Service's `ods`"""
+        # Bookings are grouped per OD first, so that each OD is extended once whatever the order of the manifest
+        ods = self._ods_by_origin
+        bookings: Dict[OD, List[Passenger]] = defaultdict(list)
         for passenger in passengers:
-            od = self.ods[(passenger.origin, passenger.destination)]
-            od.passengers.append(passenger)
+            bookings[ods[passenger.origin][passenger.destination]].append(passenger)
+
+        for od, run in bookings.items():
+            od._passengers += tuple(run)
+            od._days.extend(passenger.sale_day_x for passenger in run)
+            od._prices.extend(passenger.price for passenger in run)
+            od._manifest_version += 1
+
+            for leg in od.legs:
+                leg._passengers.extend(run)
 
 
 class Station:
     """A station is where a service can stop to let passengers board or disembark."""
 
+    __slots__ = ("name",)
+
     def __init__(self, name: str):
         self.name = name
 
@@ -75,21 +120,19 @@ class Leg:
     Example: a service whose itinerary is A-B-C has two legs: A-B and B-C.
     """
 
+    __slots__ = ("service", "origin", "destination", "_passengers")
+
     def __init__(self, service: Service, origin: Station, destination: Station):
         self.service = service
         self.origin = origin
         self.destination = destination
+        # Passengers of every OD crossing this leg, filled by `Service.load_passenger_manifest`
+        self._passengers: List[Passenger] = []
 
     @property
     def passengers(self) -> List["Passenger"]:
         """List of passengers on board (for this leg)"""
-        passengers = []
-        for od in self.service.ods.values():
-            if self not in od.legs:
-                continue
-
-            passengers.extend(od.passengers)
-        return passengers
+        return list(self._passengers)
 
 
 class OD:
@@ -98,24 +141,33 @@ class OD:
     Example: a service whose itinerary is A-B-C has up to three ODs: A-B, B-C and A-C.
     """
 
+    __slots__ = (
+        "service", "origin", "destination", "_passengers", "_days", "_prices", "_legs",
+        "_manifest_version", "_cached_history", "_cached_history_version",
+    )
+
     def __init__(self, service: Service, origin: Station, destination: Station):
         self.service = service
         self.origin = origin
         self.destination = destination
-        self.passengers: List[Passenger] = []
+        self._passengers: Tuple[Passenger, ...] = ()
+        # Sale day and price of each passenger, kept in line with `_passengers` by `Service.load_passenger_manifest`
+        self._days = array("i")
+        self._prices = array("d")
+        self._legs: Optional[List[Leg]] = None
+        # Bumped by `Service.load_passenger_manifest` on each change of the sales, to know when `history` is stale
+        self._manifest_version = 0
+        self._cached_history: List[Tuple[int, int, float]] = []
+        self._cached_history_version = 0
 
-    def _legs(self) -> Iterator[Leg]:
-        legs = iter(self.service.legs)
-
-        for leg in legs:
-            if leg.origin == self.origin:
-                yield leg
-                break
+    @property
+    def passengers(self) -> Tuple["Passenger", ...]:
+        """Passengers who bought this OD
 
-        for leg in legs:
-            if leg.origin == self.destination:
-                break
-            yield leg
+        Read only: bookings are added with `Service.load_passenger_manifest`, which also records them for `history` and
+        `forecast`.
+        """
+        return self._passengers
 
     @property
     def legs(self) -> List[Leg]:
@@ -123,64 +175,199 @@ class OD:
 
         Example: with a service whose itinerary is A-B-C, the OD A-C contains:
                  A-B and A-C
+
+        Computed once: legs are not expected to change after the service itinerary is loaded.
         """
-        return list(self._legs())
+        if self._legs is None:
+            index = self.service._stop_index()
+            self._legs = self.service.legs[index[self.origin]:index[self.destination]]
+        return self._legs
+
+    def _history(self) -> Iterator[Tuple[int, int, float]]:
+        # Sale days span a small range: bucket sales per day, then only the distinct days need to be sorted
+        buckets: Dict[int, List] = defaultdict(lambda: [0, 0.0])
+        for day_x, price in zip(self._days, self._prices):
+            bucket = buckets[day_x]
+            bucket[0] += 1
+            bucket[1] += price
 
-    def _history(self) -> Iterator[Tuple[int, int, int]]:
         head_count = wallet = 0
-        passengers = sorted(self.passengers, key=lambda p: p.sale_day_x)
-        for day_x, passengers in groupby(passengers, lambda p: p.sale_day_x):
-            for passenger in passengers:
-                head_count += 1
-                wallet += passenger.price
-
+        for day_x in sorted(buckets):
+            seats_sold, money_made = buckets[day_x]
+            head_count += seats_sold
+            wallet += money_made
             yield day_x, head_count, wallet
 
-    def history(self) -> List[Tuple[int, int, int]]:
+    def _current_history(self) -> List[Tuple[int, int, float]]:
+        if self._cached_history_version != self._manifest_version:
+            self._cached_history = list(self._history())
+            self._cached_history_version = self._manifest_version
+        return self._cached_history
+
+    def history(self) -> List[Tuple[int, int, float]]:
         """Return a history of sales as a list of triplets
 
-        Each triplet is of the form: (day_x, total_seats_sold, total_money_made)
+        Each triplet is of the form: (day_x, total_seats_sold, total_money_made), money being a float
         """
-        return list(self._history())
+        return list(self._current_history())
 
     def forecast(
             self,
             pricing: Mapping[int, int],
-            demand_matrix: Mapping[int, Mapping[int, int]]
-    ) -> Iterator[Tuple[int, int, int]]:
-        """Compute and yield a day to day forecast of sales
+            demand_matrix: Mapping[int, Mapping[int, int]],
+            monotone_demand: bool = False
+    ) -> List[Tuple[int, int, float]]:
+        """Compute a day to day forecast of sales
 
         Each forecast is of the form: (day_x, total_seats_sold, total_money_made)
+
+        Set `monotone_demand` when the demand of a day never increases with the price, so that higher prices are not
+        looked at once the demand of a day is fulfilled. `pricing` is left untouched.
         """
+        forecast, _ = self.forecast_with_seats(pricing, demand_matrix, monotone_demand)
+        return forecast
+
+    def forecast_with_seats(
+            self,
+            pricing: Mapping[int, int],
+            demand_matrix: Mapping[int, Mapping[int, int]],
+            monotone_demand: bool = False
+    ) -> Tuple[List[Tuple[int, int, float]], Dict[int, int]]:
+        """Same as `forecast`, also returning the seats left at each price after the last forecast day"""
         # Let's assume `pricing` and `demand_matrix` have their keys sorted
         # Note: since python 3.7 dict behaves like an OrderedDict
 
-        money = sum(passenger.price for passenger in self.passengers)
-        head_count = len(self.passengers)
+        if self._cached_history_version == self._manifest_version and self._cached_history:
+            # Sales made so far are the totals of the last day of an up to date history
+            _, head_count, money = self._cached_history[-1]
+        else:
+            head_count = len(self._days)
+            money = sum(self._prices, 0.0)
+
+        prices = list(pricing)
+        # Seats are sold from a copy: the caller's `pricing` can be reused for other forecasts
+        seats = list(pricing.values())
+        # Dense (day, price level) demand so that the kernel only does positional lookups
+        demand = [[day_demand[price] for price in prices] for day_demand in demand_matrix.values()]
+        if len(prices) == 5:
+            head_counts, monies = _forecast_5(prices, seats, demand, head_count, money)
+        else:
+            head_counts, monies = _forecast(prices, seats, demand, head_count, money, monotone_demand)
+
+        return list(zip(demand_matrix, head_counts, monies)), dict(zip(prices, seats))
+
+    def report(
+            self,
+            pricing: Mapping[int, int],
+            demand_matrix: Mapping[int, Mapping[int, int]],
+            monotone_demand: bool = False
+    ) -> Tuple[List[Tuple[int, int, float]], List[Tuple[int, int, float]]]:
+        """Return both the history and the forecast of sales, see `history` and `forecast`
 
-        for day, demand in demand_matrix.items():
-            sold = 0
-            for price, count in pricing.items():
-                _sold = min(demand[price] - sold, count)
-                if _sold <= 0:
-                    # XXX: if it was guarantee that the higher the price, the
-                    #      less the forecast demand, we could stop right here.
-                    continue
-                pricing[price] -= _sold
-                sold += _sold
-                money += price * _sold
+        Sales are aggregated only once: the forecast starts from the totals of the history.
+        """
+        return self.history(), self.forecast(pricing, demand_matrix, monotone_demand)
+
+
+def _forecast(
+        prices: List[int],
+        seats: List[int],
+        demand: List[List[int]],
+        head_count: int,
+        money: float,
+        monotone_demand: bool = False
+) -> Tuple[List[int], List[float]]:
+    """Run the day to day forecast over flat sequences, updating `seats` in place
+
+    `prices` and `seats` are parallel lists (seats available at each price level) and `demand` holds, for each day, the
+    demand at each price level. Return cumulative head counts and money made, one value per day.
+    """
+    # Indexes of the price levels that still have seats to sell
+    active = [j for j, available in enumerate(seats) if available > 0]
+
+    head_counts = []
+    monies = []
+    for day_demand in demand:
+        sold = 0
+        for j in active:
+            _sold = min(day_demand[j] - sold, seats[j])
+            if _sold <= 0:
+                if monotone_demand:
+                    # The higher the price, the less the demand: nothing more can be sold today
+                    break
+                continue
+            seats[j] -= _sold
+            sold += _sold
+            money += prices[j] * _sold
 
-            # XXX: we could pop prices from `pricing` as soon as the seat count
-            #      goes down to 0. This would avoid iterating over a useless
-            #      price again and again.
+        if sold:
+            active = [j for j in active if seats[j]]
 
-            head_count += sold
-            yield day, head_count, money
+        head_count += sold
+        head_counts.append(head_count)
+        monies.append(money)
+
+    return head_counts, monies
+
+
+def _forecast_5(
+        prices: List[int],
+        seats: List[int],
+        demand: List[List[int]],
+        head_count: int,
+        money: float
+) -> Tuple[List[int], List[float]]:
+    """Same as `_forecast`, specialized for the usual 5 price levels
+
+    The loop over price levels is unrolled and seats are kept in local variables. There is no need for the
+    `monotone_demand` shortcut: with such a demand, levels after the first one selling nothing sell nothing either.
+    """
+    p0, p1, p2, p3, p4 = prices
+    s0, s1, s2, s3, s4 = seats
+
+    head_counts = []
+    monies = []
+    for d0, d1, d2, d3, d4 in demand:
+        sold = 0
+        if s0 > 0 and d0 > sold:
+            n = min(d0 - sold, s0)
+            s0 -= n
+            sold += n
+            money += p0 * n
+        if s1 > 0 and d1 > sold:
+            n = min(d1 - sold, s1)
+            s1 -= n
+            sold += n
+            money += p1 * n
+        if s2 > 0 and d2 > sold:
+            n = min(d2 - sold, s2)
+            s2 -= n
+            sold += n
+            money += p2 * n
+        if s3 > 0 and d3 > sold:
+            n = min(d3 - sold, s3)
+            s3 -= n
+            sold += n
+            money += p3 * n
+        if s4 > 0 and d4 > sold:
+            n = min(d4 - sold, s4)
+            s4 -= n
+            sold += n
+            money += p4 * n
+
+        head_count += sold
+        head_counts.append(head_count)
+        monies.append(money)
+
+    seats[:] = s0, s1, s2, s3, s4
+    return head_counts, monies
 
 
 class Passenger:
     """A passenger that has a booking on a seat for a particular origin-destination."""
 
+    __slots__ = ("origin", "destination", "sale_day_x", "price")
+
     def __init__(self, origin: Station, destination: Station, sale_day_x: int, price: float):
         self.origin = origin
         self.destination = destination
@@ -228,6 +415,14 @@ od_ply_lpd = service.ods[(ply, lpd)]
 od_ply_msc = service.ods[(ply, msc)]
 od_lpd_msc = service.ods[(lpd, msc)]
 
+# The day-x scale is computed from today, unless the service is given another reference date:
+
+assert service.day_x == -7
+other_service = Service("7601", datetime.date(2024, 1, 8), reference_date=datetime.date(2024, 1, 1))
+assert other_service.day_x == -7
+other_service.reference_date = datetime.date(2024, 1, 5)
+assert other_service.day_x == -3
+
 # 3. Create a method in `Service` class that reads a passenger manifest (a list of all bookings made for this service)
 # and that allocates bookings across ODs. When called, it should fill the `passengers` attribute of each OD instances
 # belonging to the service. The signature of this method shoud be:
@@ -260,6 +455,12 @@ assert history[0] == (-30, 1, 20)
 assert history[1] == (-25, 2, 50)
 assert history[2] == (-20, 4, 130)
 
+# History is cached per OD, loading more bookings makes it up to date again:
+
+assert od_lpd_msc.history() == []
+service.load_passenger_manifest([Passenger(lpd, msc, -5, 10)])
+assert od_lpd_msc.history() == [(-5, 1, 10.0)]
+
 # 6. We want to add to our previous report some forecasted data, meaning how many bookings and revenue are forecasted
 # for next days. In revenue management, a number of seats is allocated for each prive level. Let's say we only have 5
 # price levels from 10€ to 50€. The following variable represents how many seats are available (values of the
@@ -296,3 +497,27 @@ assert forecast[4] == (-3, 15, 480.0)
 assert forecast[5] == (-2, 18, 620.0)
 assert forecast[6] == (-1, 21, 770.0)
 assert forecast[7] == (0, 21, 770.0)
+
+# Demand decreases with the price in this matrix, the forecast can stop at the first level selling nothing in a day (4
+# price levels are used here, 5 levels go through a kernel which does not need this hint):
+
+assert od_ply_lpd.forecast({20: 2, 30: 5, 40: 5, 50: 5}, demand_matrix, monotone_demand=True) == forecast
+
+# The pricing is not modified by a forecast, seats left at the end can be retrieved separately:
+
+_, remaining_seats = od_ply_lpd.forecast_with_seats(pricing, demand_matrix)
+assert pricing == {10: 0, 20: 2, 30: 5, 40: 5, 50: 5}
+assert remaining_seats == {10: 0, 20: 0, 30: 0, 40: 0, 50: 0}
+
+# Forecasts with 5 price levels go through a specialized kernel, it must skip sold out and oversold levels like the
+# generic one does:
+
+oversold_pricing = [10, 20, 30, 40, 50], [-2, 0, 1, 1, 1]
+flat_demand = [[3] * 5] * 2
+assert _forecast_5(*map(list, oversold_pricing), flat_demand, 0, 0) == ([3, 3], [120, 120])
+assert _forecast_5(*map(list, oversold_pricing), flat_demand, 0, 0) == \
+    _forecast(*map(list, oversold_pricing), flat_demand, 0, 0)
+
+# Both reports can be built at once, sales being aggregated a single time:
+
+assert od_ply_lpd.report(pricing, demand_matrix) == (history, forecast)